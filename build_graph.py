@@ -1,73 +1,88 @@
 import networkx as nx
 import re
-import hashlib
 import random
 
-from copy import deepcopy
+from functools import lru_cache
+
+
+_SPEAKER_CONTENT_RE = re.compile(r'^(?P<speaker>[^:：]+?)[:：](?P<content>.*)$', re.DOTALL)
+_TEMP_HASH_RE = re.compile(r'\${2}[0-9]{10}\${2}', re.DOTALL)
+_TEMP_HASH_LEN = 14  # len('$$') + 10 digits + len('$$')
+
+
+@lru_cache(maxsize=4096)
+def _split_speaker_and_content(string: str) -> tuple[str, str]:
+    """
+    Lines like stock NPC replies repeat a lot, so the regex split is cached.
+    The random parts are added by the caller.
+    """
+    # TODO Infer speaker name marked by "？？？".
+    match = _SPEAKER_CONTENT_RE.match(string)
+    if match:
+        return match.group('speaker').strip(), match.group('content').strip()
+
+    return '旅行者', string  # If speaker not found, use "旅行者" as default.
 
 
 class GraphBuilder:
     def __init__(self, parsed_bwiki_template):
-        random.seed() # Initialize the random number generator.
+        self.__rng = random.Random() # Seeded from system randomness.
 
-        self.__parsed_bwiki_template = parsed_bwiki_template
-        self.__speaker_content_matcher = re.compile(r'^(?P<speaker>[^:：]+?)[:：](?P<content>.*)$', re.DOTALL)
-        self.__temp_hash_matcher = re.compile(r'\${2}[0-9]{10}\${2}', re.DOTALL)
+        # "任务剧情" sections are skipped when building.
+        self.__sections = [section for section in parsed_bwiki_template
+                           if section[0]['content'] != '任务剧情']
 
     def __get_speaker_name_and_content(self, string: str):
+        """
+        Returns `(None, None, None)` for blank lines. Otherwise, none of the
+        three values is `None`, so checking the hash is enough.
+        """
         if string.strip() == '':
             return None, None, None
         
-        # TODO Infer speaker name marked by "？？？".
-        match = self.__speaker_content_matcher.match(string)
-        if match:
-            speaker = match.group('speaker').strip()
-            content = match.group('content').strip()
-        else:
-            speaker = '旅行者'  # If speaker not found, use "旅行者" as default.
-            content = string
-        
-        content += f'_{random.randint(1000, 9999)}'
+        speaker, content = _split_speaker_and_content(string)
+        content += f'_{self.__rng.getrandbits(14)}'
 
-        # Random integer is added, considering that the potentially same speaker and talk text.
-        temp_hash = hashlib.md5(string.encode() + bytes(random.randint(1000, 9999))).hexdigest()[:10]
+        # The hash only serves as a unique node id, considering that the
+        # potentially same speaker and talk text. 40 random bits, formatted as
+        # 10 hex chars, are enough and need no encoding of the string.
+        temp_hash = f'{self.__rng.getrandbits(40):010x}'
 
         return temp_hash, speaker, content
 
     def __convert_str_seq_into_node_list(self, str_seq:list[str], node_type: list[str]):
-        speaker_content_pairs = map(self.__get_speaker_name_and_content, str_seq)
+        results = [(*self.__get_speaker_name_and_content(s), nt)
+                   for s, nt in zip(str_seq, node_type)]
 
-        return {
-            md5: {'speaker': speaker, 'content': content, 'node_type': node_type}
-            for (md5, speaker, content), node_type in zip(speaker_content_pairs, node_type)
-            if all((md5, speaker, content))
-        }
+        nodes = {}
+        for md5, speaker, content, nt in results:
+            if md5 is not None:
+                nodes[md5] = {'speaker': speaker, 'content': content, 'node_type': nt}
+
+        return nodes
 
     @staticmethod
     def __find_option_plot_pair(temp_parts:list[dict]):
-        pair = {}
+        """
+        Returns two dicts keyed by option name: the position of each option
+        and the position of its paired plot (`None` if it has none).
+        """
+        option_pos: dict[str, int] = {}
+        plot_pos: dict[str, int | None] = {}
 
         for idx, part in enumerate(temp_parts):
             name: str = part['name']
-            if name.find('选项') != -1:
-                if name in pair:
+            if '选项' in name:
+                if name in option_pos:
                     raise ValueError('Redundant "选项" found.')
                 
-                pair[name] = {
-                    'plot': None,
-                    'plot_pos': None,
-                    'option_pos': idx
-                }
-            elif name.find('剧情') != -1:
-                if name in pair:
-                    raise ValueError('Redundant "剧情" found.')
-
-                plot_idx = int(name[-1].strip())
-                option_of_plot = f'选项{plot_idx}'
-                if option_of_plot in pair:
-                    if pair[option_of_plot]['plot'] is None:
-                        pair[option_of_plot]['plot'] = name
-                        pair[option_of_plot]['plot_pos'] = idx
+                option_pos[name] = idx
+                plot_pos[name] = None
+            elif '剧情' in name:
+                option_of_plot = f'选项{int(name[-1])}'
+                if option_of_plot in option_pos:
+                    if plot_pos[option_of_plot] is None:
+                        plot_pos[option_of_plot] = idx
                     else:
                         raise ValueError('Existing "剧情" found.')
                 else:
@@ -75,13 +90,22 @@ class GraphBuilder:
             else:
                 raise ValueError(f'The passed ({name}) is neither "剧情" nor "选项".')
 
-        return pair
+        return option_pos, plot_pos
     
+    @staticmethod
+    def __is_plot_option_template(components: list[dict]) -> bool:
+        return components[0]['type'] == 'template_name' and components[0]['content'] == '剧情选项'
+
     def __build_plot_option_graph(self, 
                                   plot_option_template: list[dict],
                                   graph: nx.DiGraph | None = None,
                                   prev_node_names: list[str] | None = None,
                                   branch_name: str = 'None') -> dict:
+        """
+        Nested "剧情选项" templates are handled with an explicit stack of
+        `__plot_option_level` generators instead of recursion. A level yields
+        the nested template it meets and is resumed with that template's ends.
+        """
         if prev_node_names is None:
             prev_node_names: list[str] = ['START']
 
@@ -89,97 +113,143 @@ class GraphBuilder:
             graph = nx.DiGraph()
             graph.add_node(prev_node_names[0])
 
-        if plot_option_template[0]['type'] == 'template_name' and plot_option_template[0]['content'] == '剧情选项':
-            pair = self.__find_option_plot_pair(plot_option_template[1:])
-
-            options_to_be_connected = {}
-            for option_name, option_info in pair.items():
-                option = plot_option_template[option_info['option_pos'] + 1]
-            
-                o_md5, o_speaker, o_content = self.__get_speaker_name_and_content(option['value'])
-                if all((o_md5, o_speaker, o_content)):
-                    graph.add_node(
-                        o_md5,
-                        speaker = o_speaker,
-                        content = f'{o_content}',
-                        node_type = f'option{option_name[-1]}',
-                        branch_name = branch_name
-                    )
-                    graph.add_edges_from(
-                        zip(prev_node_names, [o_md5] * len(prev_node_names))
-                    )
-                    options_to_be_connected[option_name] = o_md5
-
-            for option_name, option_info in pair.items():
-                if option_info['plot_pos'] is None:
-                    continue
-
-                paired_plot = plot_option_template[option_info['plot_pos'] + 1]
-                paired_plot_name = paired_plot['name']
-                paired_plot_value = paired_plot['value']
-                if isinstance(paired_plot_value, str):
-                    paired_plot_value = [paired_plot_value]
-
-                prev_node_names = [options_to_be_connected[option_name]]
-                value: str
-                for value in paired_plot_value:
-                    if self.__temp_hash_matcher.match(value) is not None:
-                        temp_hash = value.replace('$', '')
-
-                        prev_node_names = \
-                            self.__build_plot_option_graph(
-                                paired_plot['nested_temp'][temp_hash], 
-                                graph, 
-                                prev_node_names,
-                                branch_name=str(random.randint(10000, 99999)))['end'] #type:ignore
-                    else:
-                        p_md5, p_speaker, p_content = self.__get_speaker_name_and_content(value)
-
-                        if all((p_md5, p_speaker, p_content)):
-                            graph.add_node(
-                                p_md5,
-                                speaker = p_speaker,
-                                content = f'{p_content}',
-                                node_type = f'plot{paired_plot_name[-1]}',
-                                branch_name = branch_name
-                            )
-                            graph.add_edges_from(
-                                zip(prev_node_names, [p_md5] * len(prev_node_names))
-                            )
-                            prev_node_names = [p_md5]
-            
-            node_attr_and_degree = \
-                zip(nx.get_node_attributes(graph, 'branch_name').items(), list(graph.out_degree)[1:])
-            end = \
-                [node 
-                for (node, at_branch), (_, degree) in  node_attr_and_degree
-                if at_branch == branch_name and degree == 0]
-            # This return is for building plot option graph only.
-            return {
-                'graph': graph,
-                'start': 'START',
-                'end': end,
-            }
-        else:
+        if not self.__is_plot_option_template(plot_option_template):
             return self.__handle_component(plot_option_template)
+
+        stack = [self.__plot_option_level(plot_option_template, graph, prev_node_names, branch_name)]
+        sent = None
+        while True:
+            try:
+                nested_template, nested_prev, nested_branch = stack[-1].send(sent)
+            except StopIteration as finished:
+                stack.pop()
+                if not stack:
+                    # This return is for building plot option graph only.
+                    return {
+                        'graph': graph,
+                        'start': prev_node_names[0],
+                        'end': finished.value,
+                    }
+                sent = finished.value
+                continue
+
+            if self.__is_plot_option_template(nested_template):
+                stack.append(
+                    self.__plot_option_level(nested_template, graph, nested_prev, nested_branch))
+                sent = None
+            else:
+                sent = self.__handle_component(nested_template)['end'] #type:ignore
+
+    def __plot_option_level(self,
+                            plot_option_template: list[dict],
+                            graph: nx.DiGraph,
+                            prev_node_names: list[str],
+                            branch_name: str):
+        """
+        Adds one level of a "剧情选项" template to `graph` and returns the end
+        nodes of this level. See `__build_plot_option_graph`.
+        """
+        option_pos, plot_pos = self.__find_option_plot_pair(plot_option_template[1:])
+
+        # Nodes added at this level. Used for finding ends of this branch
+        # without rescanning the whole graph.
+        branch_nodes: list[str] = []
+        # Nodes and edges are collected here and added to the graph in
+        # batches, before descending into a nested template and before
+        # returning.
+        pending_nodes: list[tuple[str, dict]] = []
+        pending_edges: list[tuple[str, str]] = []
+
+        def flush_pending():
+            graph.add_nodes_from(pending_nodes)
+            graph.add_edges_from(pending_edges)
+            pending_nodes.clear()
+            pending_edges.clear()
+
+        for option_name, o_pos in option_pos.items():
+            option = plot_option_template[o_pos + 1]
+        
+            o_md5, o_speaker, o_content = self.__get_speaker_name_and_content(option['value'])
+            if o_md5 is None:
+                continue
+
+            pending_nodes.append((o_md5, {
+                'speaker': o_speaker,
+                'content': f'{o_content}',
+                'node_type': f'option{option_name[-1]}',
+                'branch_name': branch_name
+            }))
+            pending_edges.extend((p, o_md5) for p in prev_node_names)
+            branch_nodes.append(o_md5)
+
+            p_pos = plot_pos[option_name]
+            if p_pos is None:
+                continue
+
+            paired_plot = plot_option_template[p_pos + 1]
+            paired_plot_name = paired_plot['name']
+            paired_plot_value = paired_plot['value']
+            if type(paired_plot_value) is str:
+                paired_plot_value = (paired_plot_value,)
+
+            # `prev_node_names` is kept for the remaining options. The
+            # plot lines chain from the option node.
+            tail_nodes = [o_md5]
+            value: str
+            for value in paired_plot_value:
+                # Cheap checks first; most values are plain lines.
+                if (len(value) >= _TEMP_HASH_LEN and value.startswith('$$')
+                        and _TEMP_HASH_RE.match(value) is not None):
+                    temp_hash = value.replace('$', '')
+
+                    flush_pending()
+                    # Handed to `__build_plot_option_graph`, which sends
+                    # back the ends of the nested template.
+                    tail_nodes = yield (
+                        paired_plot['nested_temp'][temp_hash],
+                        tail_nodes,
+                        f'{self.__rng.getrandbits(20):05d}'
+                    )
+                else:
+                    p_md5, p_speaker, p_content = self.__get_speaker_name_and_content(value)
+
+                    if p_md5 is not None:
+                        pending_nodes.append((p_md5, {
+                            'speaker': p_speaker,
+                            'content': f'{p_content}',
+                            'node_type': f'plot{paired_plot_name[-1]}',
+                            'branch_name': branch_name
+                        }))
+                        pending_edges.extend((p, p_md5) for p in tail_nodes)
+                        branch_nodes.append(p_md5)
+                        tail_nodes = [p_md5]
+        
+        flush_pending()
+        out_degree = graph.out_degree  # bind the view once
+        return [node for node in branch_nodes if out_degree(node) == 0]
     
     def __warpped_build_plot_option_graph(self, components: list, is_followed_by_lines: bool):
-        graph: nx.DiGraph = self.__build_plot_option_graph(components)['graph']
+        # Each plot option graph gets its own START/END nodes. With plain
+        # 'START'/'END', composing several of them would merge the sentinels.
+        suffix = f'{self.__rng.getrandbits(40):010x}'
+        start, end = f'START_{suffix}', f'END_{suffix}'
+
+        graph: nx.DiGraph = self.__build_plot_option_graph(components, prev_node_names=[start])['graph']
         leaf_nodes = [n for (n, degree) in graph.out_degree if degree == 0]
 
         if is_followed_by_lines:
-            graph.add_node('END')
-            graph.add_edges_from([(node, 'END') for node in leaf_nodes])
+            graph.add_node(end)
+            graph.add_edges_from((node, end) for node in leaf_nodes)
 
             return {
                 'graph': graph,
-                'start': 'START',
-                'end': 'END'
+                'start': start,
+                'end': end
             }
         else:
             return {
                 'graph': graph,
-                'start': 'START',
+                'start': start,
                 'end': leaf_nodes
             }
     
@@ -205,11 +275,7 @@ class GraphBuilder:
             graph.add_nodes_from(nodes)
 
             hash_list = list(nodes.keys())
-            origins = deepcopy(hash_list)
-            origins.pop(-1)
-            destinations = deepcopy(hash_list)
-            destinations.pop(0)
-            graph.add_edges_from(zip(origins, destinations))
+            graph.add_edges_from(zip(hash_list, hash_list[1:]))
 
             return_dict['graph'] = graph # type: ignore
             return_dict['start'] = hash_list[0] # type: ignore
@@ -236,35 +302,59 @@ class GraphBuilder:
         else:
             raise NotImplementedError(f'You need to assign a method to handle the {components[0]['type']}.')
 
-    def build(self):
+    @staticmethod
+    def __compose(G: nx.DiGraph, sub: nx.DiGraph, shared: tuple = ()):
+        """
+        Adds `sub` into `G` in place. `nx.union` copies the whole of G on every
+        call. Like `nx.union`, this fails when the graphs have a node in
+        common (other than those in `shared`) instead of merging it silently.
+        """
+        overlap = [n for n in sub if n in G and n not in shared]
+        if overlap:
+            raise nx.NetworkXError(
+                f'The node sets of the graphs are not disjoint: {overlap[:5]}')
+
+        G.update(sub)
+
+    def __build_section(self, section: list) -> nx.DiGraph:
+        """
+        Builds the graph of one section. Sections are not linked to each
+        other, so each one can be built on its own.
+        """
         G = nx.DiGraph()
 
-        for section in self.__parsed_bwiki_template:
-            section_name = section[0]['content'] # type: ignore
-            if section_name == '任务剧情':
-                continue
+        section_name = section[0]['content'] # type: ignore
+        G.add_node(section_name, section_name = section_name)
 
-            G.add_node(section_name, section_name = section_name)
+        prev_node: str = section_name
+        for idx, sec_components in enumerate(section[1:]):
 
-            prev_node: str = section_name
-            for idx, sec_components in enumerate(section[1:]):
+            for component_idx, component in enumerate(sec_components):
+                if component_idx < len(sec_components):
+                    graph_dict = self.__handle_component(component, is_followed_by_other_lines=True)
+                elif component_idx == len(sec_components):
+                    graph_dict = self.__handle_component(component, is_followed_by_other_lines=False)
 
-                for component_idx, component in enumerate(sec_components):
-                    if component_idx < len(sec_components):
-                        graph_dict = self.__handle_component(component, is_followed_by_other_lines=True)
-                    elif component_idx == len(sec_components):
-                        graph_dict = self.__handle_component(component, is_followed_by_other_lines=False)
-    
-                    if graph_dict is not None:
-                        new_G = nx.union(G, graph_dict['graph'], rename=('', ''))
-
-                        if isinstance(prev_node, list):
-                            new_G.add_edges_from([(n, graph_dict['start']) for n in prev_node])
-                        elif isinstance(prev_node, str):
-                            new_G.add_edges_from([(prev_node, graph_dict['start'])])
-                        
-                        G = new_G
-                        prev_node = graph_dict['end'] # type: ignore
+                if graph_dict is not None:
+                    self.__compose(G, graph_dict['graph'])
+
+                    if isinstance(prev_node, list):
+                        G.add_edges_from((n, graph_dict['start']) for n in prev_node)
+                    elif isinstance(prev_node, str):
+                        G.add_edge(prev_node, graph_dict['start'])
+                    
+                    prev_node = graph_dict['end'] # type: ignore
+
+        return G
+
+    def build(self):
+        G = nx.DiGraph()
+
+        for section in self.__sections:
+            # Equally named sections share their section node, as when every
+            # section was built into one graph.
+            self.__compose(G, self.__build_section(section),
+                           shared=(section[0]['content'],))
 
         return G
 
@@ -1,18 +1,94 @@
 import hashlib
 import re
 
+from dataclasses import dataclass, field
+from typing import Any
+
 import wikitextparser as wtp
 
 
+# HTML tags (`<br>` included) are stripped by `_strip_tags`.
+_CLEAN_RE = re.compile(r':|\*|----')
+_PREPROCESS_RE = re.compile(r'<tabber>|</tabber>|\|-\|')
+_PREPROCESS_MAP = {
+    '<tabber>': '{{tabber|',
+    '</tabber>': '}}',
+    '|-|': '|'
+}
+# Let the option template scanner jump over runs of characters it does not
+# stop at, instead of stepping one character at a time.
+_NON_PUNCTUATOR_RE = re.compile(r'[^{}|=]*')
+_NESTED_TEMP_STOP_RE = re.compile(r'[{}|]')
+_BRACE_RE = re.compile(r'[{}]')
+_WHITESPACE_RE = re.compile(r'\s+')
+_NON_EMPTY_LINE_RE = re.compile(r'[^\n]+')
+
+
+def _strip_tags(string: str):
+    """
+    Yields the text between HTML tags. Same as removing `<[^>]+>` matches, but
+    with `str.find` instead of the regex engine.
+    """
+    start = pos = 0
+    while (left := string.find('<', pos)) != -1:
+        right = string.find('>', left + 1)
+        if right == -1:
+            break
+        if right == left + 1:  # "<>" is not a tag.
+            pos = right
+            continue
+
+        yield string[start:left]
+        start = pos = right + 1
+
+    yield string[start:]
+
+
+@dataclass(slots=True)
+class Token:
+    """
+    A token produced by `ParseOptionTemplate`. Only "template" tokens use
+    `name`, `nested_temp_spans`, `value` and `nested_temp`.
+    """
+    type: str
+    content: str = ''
+    name: str = ''
+    nested_temp_spans: list[tuple[int, int]] = field(default_factory=list)
+    value: Any = None
+    is_nested_temp: bool = False
+    nested_temp: dict | None = None
+
+    def as_dict(self) -> dict:
+        """The dict form used in the parsing result."""
+        if self.type != 'template':
+            return {
+                'type': self.type,
+                'content': self.content,
+                'is_nested_temp': self.is_nested_temp
+            }
+
+        output = {
+            'type': self.type,
+            'name': self.name,
+            'nested_temp_spans': self.nested_temp_spans,
+            'value': self.value,
+            'is_nested_temp': self.is_nested_temp
+        }
+        if self.nested_temp is not None:
+            output['nested_temp'] = self.nested_temp
+        return output
+
+
 class ParseOptionTemplate:
     """Dedicates to parse "剧情选项" templates. It should have been written with
     libraries like `wikitextparser`. They can greatly simplify this parser and
     are more convenient.
     """
 
+    _PUNCTUATORS = frozenset({'{', '}', '|', '='})
+
     def __init__(self, code: str) -> None:
         self._code = code
-        self._punctuators = ['{', '}', '|', '=']
         self._is_in_template = False
         self._start = 0
         self._end = 0
@@ -33,8 +109,7 @@ class ParseOptionTemplate:
         return char
 
     def _get_param_val(self):
-        while self._peek() != '=':
-            self._advance()
+        self._end = self._code.index('=', self._end)
 
         param_name = self._code[self._start + 1: self._end]
         # self._start + 1 is to remove | before parameter.
@@ -43,56 +118,52 @@ class ParseOptionTemplate:
         self._start = self._end
 
         nested_temp_start = None
-        nested_temp_end = None
         nested_temp_spans = []
         nested_temp_counter = 0
-        pos = 0
 
-        code = self._code[self._start:]
-        while pos < len(code):
-            char = code[pos]
+        # Walk `self._code` in place from the start of the value, jumping from
+        # one brace or pipe to the next. Spans are relative to the value.
+        code = self._code
+        base = self._start
+        pos = base
+        while True:
+            # Pipes inside nested templates do not end the value.
+            stop_re = _NESTED_TEMP_STOP_RE if nested_temp_counter == 0 else _BRACE_RE
+            if (stop := stop_re.search(code, pos)) is None:
+                pos = max(pos, len(code))
+                break
+            pos = stop.start()
 
+            char = code[pos]
             if char == '{':
                 if nested_temp_start is None:
                     nested_temp_start = pos
-                    pos += 2  # skip the following embrace
-                    nested_temp_counter += 1
-                else:
-                    nested_temp_counter += 1
-                    pos += 2  # skip the following embrace
+                nested_temp_counter += 1
+                pos += 2  # skip the following embrace
             elif char == '}':
                 if nested_temp_counter > 0:
                     nested_temp_counter -= 1
                     pos += 2  # skip the following embrace
                 if nested_temp_counter == 0:
-                    if (nested_temp_start is not None and
-                            nested_temp_end is None):
-                        nested_temp_end = pos
+                    if nested_temp_start is not None:
                         nested_temp_spans.append(
-                            (nested_temp_start, nested_temp_end))
-
+                            (nested_temp_start - base, pos - base))
                         nested_temp_start = None
-                        nested_temp_end = None
-                    elif code[pos + 1] != '' and code[pos + 1] != '}':
+                    elif code[pos + 1] != '}':
                         pos += 1
-                        continue
                     else:
                         break
-            elif char == '|' and nested_temp_counter == 0:
+            else:  # "|" outside nested templates
                 break
-            else:  # for characters not punctuators
-                pos += 1
 
-        self._end += pos
-        content = code[:pos]
-        output = {
-            'type': 'template',
-            'name': param_name,
-            'nested_temp_spans': nested_temp_spans,
-            'value': content.strip(),
-            'is_nested_temp': False
-        }
-        return output
+        self._end = pos
+        content = code[base:pos]
+        return Token(
+            type='template',
+            name=param_name,
+            nested_temp_spans=nested_temp_spans,
+            value=content.strip()
+        )
 
     def _parse(self):
         """
@@ -102,119 +173,143 @@ class ParseOptionTemplate:
         char = self._eat()
 
         match char:
-            case space if space.isspace():
-                return None
             case char if char == '|' and self._is_in_template:
                 return self._get_param_val()
             case '{':
                 self._is_in_template = True
                 self._advance()  # skip the following embrace.
                 return None
-            case char if char not in self._punctuators:
-                while self._peek() not in self._punctuators:
-                    self._advance()
-                return {
-                    'type': 'template_name'
-                            if self._is_in_template else 'common_string',
-                    'content': self._code[self._start: self._end].strip(),
-                    'is_nested_temp': False
-                }
+            case char if char not in self._PUNCTUATORS:
+                self._end = _NON_PUNCTUATOR_RE.match(self._code, self._end).end()
+                return Token(
+                    type='template_name'
+                         if self._is_in_template else 'common_string',
+                    content=self._code[self._start: self._end].strip()
+                )
             case '}':
                 return None
             case _:
                 raise ValueError(f'Not supported character: {char}')
 
     def scan(self):
-        tokens = []
+        """Yields tokens one by one."""
         while not self._is_at_end():
+            # Skip a whole run of whitespace at once.
+            if whitespace := _WHITESPACE_RE.match(self._code, self._end):
+                self._start = self._end = whitespace.end()
+                continue
+
             if token := self._parse():
-                tokens.append(token)
+                yield token
             self._start = self._end
-        return tokens
 
 
 class Parse:
+    _IGNORED_TEMPLATES = frozenset({
+        '任务',
+        '面包屑',
+        'JS',
+        '左侧目录',
+        '提示',
+        '任务描述',
+        '图标',
+        '黑幕',
+        '图片放大',
+        '悬浮框'
+    })
+
     def __init__(self, code: str) -> None:
         self.__code = self.__preprocess(code)
-        self.__ignored_templates = [
-            '任务',
-            '面包屑',
-            'JS',
-            '左侧目录',
-            '提示',
-            '任务描述',
-            '图标',
-            '黑幕',
-            '图片放大',
-            '提示',
-            '悬浮框'
-        ]
+        # Results of `wtp.parse` within one section. Cleared after each
+        # section is parsed.
+        self.__wtp_cache: dict[str, wtp.WikiText] = {}
+        self.__top_templates_cache: dict[str, list[wtp.Template]] = {}
+
+    def __wtp_parse(self, string: str) -> wtp.WikiText:
+        parsed = self.__wtp_cache.get(string)
+        if parsed is None:
+            parsed = wtp.parse(string)
+            self.__wtp_cache[string] = parsed
+
+        return parsed
+
+    def __top_level_templates(self, string: str) -> list[wtp.Template]:
+        # `nesting_level` walks the ancestors of each template, so the filtered
+        # list is cached along with the parse result.
+        top = self.__top_templates_cache.get(string)
+        if top is None:
+            top = [t for t in self.__wtp_parse(string).templates
+                   if t.nesting_level == 1]
+            self.__top_templates_cache[string] = top
+
+        return top
+
+    def __clear_caches(self):
+        self.__wtp_cache.clear()
+        self.__top_templates_cache.clear()
 
     @staticmethod
     def __preprocess(code: str):
-        return code.replace('<tabber>', '{{tabber|')\
-                   .replace('</tabber>', '}}')\
-                   .replace('|-|', '|')
+        return _PREPROCESS_RE.sub(lambda m: _PREPROCESS_MAP[m.group(0)], code)
 
     @staticmethod
     def __clean_string(string: str):
-        unwanted_chars: list[str] = [
-            ':',
-            '<br>',
-            '*',
-            '----'
-        ]
-        escaped_chars = [re.escape(char) for char in unwanted_chars]
-        pattern = '|'.join(escaped_chars) + '|<[^>]+>'
+        # Removes ':', '<br>', '*', '----' and HTML tags.
+        if '<' not in string:
+            return _CLEAN_RE.sub('', string)
 
-        return re.sub(pattern, '', string)
+        # Cleaning each piece on its own, so that text joined across a
+        # removed tag is left as is.
+        return ''.join(_CLEAN_RE.sub('', part) for part in _strip_tags(string))
 
     def __sequence_string(self, string: str):
         string = string.strip()
-        string = self.__clean_string(string)
+        # Cleaning changes nothing unless one of these characters is present,
+        # which is the case for most values.
+        if '<' in string or ':' in string or '*' in string or '-' in string:
+            string = self.__clean_string(string)
 
         if string.find('\n') == -1:
             return string if string else None
         else:
-            return [s for s in string.split('\n') if s]
+            return _NON_EMPTY_LINE_RE.findall(string)
 
     def __numeric_hash(self, text: str):
         '''
         To cope with the missing 'b' in MD5 in the next method
         (see `__parse_plot_option_temp` and its comments).
+
+        The result must stay 10 digits: `GraphBuilder` looks for `$$` + 10
+        digits + `$$` in plot values.
         '''
-        hash_bytes = hashlib.sha256(text.encode()).digest()
+        hash_bytes = hashlib.blake2b(text.encode(), digest_size=8).digest()
         hash_int = int.from_bytes(hash_bytes, byteorder='big')
-        return str(hash_int)[:10]
+        return f'{hash_int % 10 ** 10:010d}'
 
     def __parse_plot_option_temp(self, code: str):
         expanded = []
 
-        def traverse_nested_template(temp_dict: dict):
+        def traverse_nested_template(token: Token):
             has_no_nested_temp = \
-                (temp_dict['type'] in ['redundant_string', 'template_name']
+                (token.type in ['redundant_string', 'template_name']
                  or
-                 len(temp_dict['nested_temp_spans']) == 0
+                 len(token.nested_temp_spans) == 0
                  )
             if has_no_nested_temp:
-                if 'value' in temp_dict:
-                    if seq := self.__sequence_string(temp_dict['value']):
-                        temp_dict['value'] = seq
+                if token.type == 'template':
+                    if seq := self.__sequence_string(token.value):
+                        token.value = seq
                 
-                if not temp_dict['is_nested_temp']:
-                    expanded.append(temp_dict)
+                if not token.is_nested_temp:
+                    expanded.append(token.as_dict())
                 
                 return
-<<<<<<< HEAD
-            
-=======
 
->>>>>>> b6b27b02b97bc834a52ca4b9a6ed2af342b7c8b6
-            value = temp_dict['value']
+            value = token.value
             nested_temp = {}
             string_with_replaced_temps = []
             slice_start = 0
-            for (nested_temp_left_pos, nested_temp_right_pos) in temp_dict['nested_temp_spans']:
+            for (nested_temp_left_pos, nested_temp_right_pos) in token.nested_temp_spans:
                 string_with_replaced_temps.append(
                     value[slice_start:nested_temp_left_pos])
                 slice_start = nested_temp_right_pos
@@ -228,31 +323,46 @@ class Parse:
                 temp_md5 = self.__numeric_hash(nested_temp_string)
                 string_with_replaced_temps.append(f'$${temp_md5}$$')
 
-                parser_ = ParseOptionTemplate(nested_temp_string)
-                parsed = parser_.scan()
-                is_plot_option_temp = \
-                    any(plot_option_parsing_result['type'] == 'template_name' and
-                        plot_option_parsing_result['content'] == '剧情选项'
-                        for plot_option_parsing_result in parsed)
+                # Most nested templates are not "剧情选项". Scanning is only
+                # needed when the name can be there at all.
+                if '剧情选项' in nested_temp_string:
+                    parser_ = ParseOptionTemplate(nested_temp_string)
+                    parsed = list(parser_.scan())
+                    is_plot_option_temp = \
+                        any(plot_option_parsing_result.type == 'template_name' and
+                            plot_option_parsing_result.content == '剧情选项'
+                            for plot_option_parsing_result in parsed)
+                else:
+                    parsed = None
+                    is_plot_option_temp = False
+
                 if not is_plot_option_temp:
-                    for t in wtp.parse(nested_temp_string).templates:
-                        # only top-level template(s) needed
-                        if t.nesting_level == 1:
+                    # only top-level template(s) needed
+                    top_templates = self.__top_level_templates(nested_temp_string)
+                    if top_templates:
+                        for t in top_templates:
                             parsed = self.__handle_temp(t)
+                    else:
+                        # Nothing for wtp to handle. Keep the scanned tokens as
+                        # before, scanning now if that was skipped above.
+                        if parsed is None:
+                            parsed = ParseOptionTemplate(nested_temp_string).scan()
+                        parsed = [token.as_dict() for token in parsed]
                 else:
                     for parsing_result in parsed:
-                        parsing_result.update({'is_nested_temp': True})
+                        parsing_result.is_nested_temp = True
                         traverse_nested_template(parsing_result)
+                    parsed = [parsing_result.as_dict() for parsing_result in parsed]
 
                 if parsed is not None:
                     nested_temp.update({temp_md5: parsed})
 
             string_with_replaced_temps.append(
                 value[slice_start:])  # append remains of the code
-            temp_dict['value'] = self.__sequence_string(''.join(string_with_replaced_temps))
-            temp_dict.update({'nested_temp': nested_temp})
-            if not temp_dict['is_nested_temp']:
-                expanded.append(temp_dict)
+            token.value = self.__sequence_string(''.join(string_with_replaced_temps))
+            token.nested_temp = nested_temp
+            if not token.is_nested_temp:
+                expanded.append(token.as_dict())
 
         parser = ParseOptionTemplate(code)
         for d in parser.scan():
@@ -263,21 +373,23 @@ class Parse:
     def __parse(self, string: str):
         parts = []
         prev_temp_right_pos = 0
-        parsed = wtp.parse(string)
-        top_templates = [t for t in parsed.templates if t.nesting_level == 1]
+        top_templates = self.__top_level_templates(string)
+        # `span` is computed on each access, so read every one only once.
+        spans = [t.span for t in top_templates]
 
         template: wtp.Template
         for idx, template in enumerate(top_templates):
+            span0, span1 = spans[idx]
             if idx < len(top_templates) - 1:
                 # start of next top-level template
-                nxt_slice_pos = top_templates[idx + 1].span[0]
+                nxt_slice_pos = spans[idx + 1][0]
             else:
                 nxt_slice_pos = None
 
             left, t, right = (
-                string[prev_temp_right_pos:template.span[0]],
+                string[prev_temp_right_pos:span0],
                 self.__handle_temp(template),
-                string[template.span[1]:nxt_slice_pos] if nxt_slice_pos else string[template.span[1]:]
+                string[span1:nxt_slice_pos] if nxt_slice_pos else string[span1:]
             )
             prev_temp_right_pos = nxt_slice_pos
 
@@ -303,12 +415,11 @@ class Parse:
         return parts
 
     def __handle_temp(self, template: wtp.Template):
-        if template.name in self.__ignored_templates:
+        name = template.name.strip()
+        if name in self._IGNORED_TEMPLATES:
             return None
 
-        match template.name.strip():
-            case temp_name if temp_name in self.__ignored_templates:
-                return None
+        match name:
             case 'tabber':
                 return [arg.value for arg in template.arguments]
             case '剧情选项':
@@ -340,7 +451,7 @@ class Parse:
                         }]
                     return None
             case _:
-                raise NotImplementedError(f'{template.name} has no parsing function.')
+                raise NotImplementedError(f'{name} has no parsing function.')
 
     def __parse_by_section(self, section: wtp.Section):
         if title := section.title:
@@ -354,27 +465,42 @@ class Parse:
         else:
             return None
 
-    def parse(self):
-        parsed_sections = []
-        sections = wtp.parse(self.__code).sections
-
-        lvl2_section = sections[1]
-        deeper_sections = sections[2:]
-        lines_between = lvl2_section.string.replace(
-            ''.join([a.string for a in deeper_sections]).strip(), '')
-        sections = deeper_sections
-        if lines_between != '':
-            sections = wtp.parse(lines_between).sections + sections
-            # There will be just one section.
-
-        for sec in sections:
-            if parsed := self.__parse_by_section(sec):
-                parsed_sections.append(parsed)
+    def iter_sections(self):
+        """
+        Yields parsed sections one at a time, so a caller can write each one
+        out without holding the whole page. Only the `wtp` parse of the page
+        source itself is kept across sections.
+        """
+        try:
+            sections = self.__wtp_parse(self.__code).sections
+
+            lvl2_section = sections[1]
+            deeper_sections = sections[2:]
+            # Lines between the level 2 title and its first subsection. Both
+            # spans are offsets into `self.__code`.
+            offset = lvl2_section.span[0]
+            first_deeper_start = \
+                deeper_sections[0].span[0] if deeper_sections else len(self.__code)
+            lines_between = lvl2_section.string[:first_deeper_start - offset]
+            sections = deeper_sections
+            if lines_between != '':
+                sections = self.__wtp_parse(lines_between).sections + sections
+                # There will be just one section.
+
+            for sec in sections:
+                parsed = self.__parse_by_section(sec)
+                # Cached results are reused within a section only.
+                self.__clear_caches()
+                if parsed:
+                    yield parsed
+        finally:
+            self.__clear_caches()
 
-        return parsed_sections
+    def parse(self):
+        return list(self.iter_sections())
 
 if __name__ == '__main__':
-    from json import dump
+    from json import dumps
 
 
     with open(r'scripts/template.txt', 'r', encoding='utf-8') as fp:
@@ -382,6 +508,12 @@ if __name__ == '__main__':
 
     p = Parse(code)
 
+    # Written section by section. The output is the same as dumping
+    # `p.parse()` with `indent=4`.
     with open('test_template.json', 'w', encoding='utf-8') as fp:
-        dump(p.parse(), fp, ensure_ascii=False, indent=4)
-
+        separator = '[\n    '
+        for section in p.iter_sections():
+            fp.write(separator)
+            fp.write(dumps(section, ensure_ascii=False, indent=4).replace('\n', '\n    '))
+            separator = ',\n    '
+        fp.write('[]' if separator == '[\n    ' else '\n]')